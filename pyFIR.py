@@ -27,15 +27,130 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
+import math
 import numpy as np
-from numpy.core.fromnumeric import partition
-from numpy.core.numeric import Inf
-from numpy.fft import fft, ifft
+import scipy.fft
+from functools import partial
+from threading import Lock, Thread
 from time import time
+try:  # optional, FFTW plans are used instead of pocketfft when available
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+try:  # optional, compiles the UPOLS frequency-domain multiply-accumulate
+    from numba import njit, prange, typeof, types
+    from numba.extending import overload
+except ImportError:
+    njit = None
+try:  # optional, GPU UPOLS ('upols-gpu')
+    import cupy as cp
+except ImportError:
+    cp = None
+
+
+TILE_BYTES = 256 * 1024  # size of the (bins x partitions) slabs of FDL_T and H_T processed at a time (~L2)
+
+
+def to_bfloat16(a):
+    '''float32 array -> bfloat16 bit patterns (uint16), rounded to nearest even'''
+    bits = a.view(np.uint32)
+    return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+
+def from_bfloat16(b):
+    '''bfloat16 bit patterns (uint16) -> float32 array'''
+    return (b.astype(np.uint32) << 16).view(np.float32)
+
+
+def upols_mac(FDL_T, H_T, idx):
+    '''
+    sum over partitions p of FDL_T[:, idx[p]] * H_T[:, p], one cache-sized tile of bins at a time.
+    H_T is complex64 or, for a quantized filter, its interleaved re/im parts as bfloat16 (see to_bfloat16).
+    '''
+    K, P = FDL_T.shape[0], idx.shape[0]
+    k_tile = max(1, TILE_BYTES // (2 * P * 8))
+    acc = np.empty(K, dtype=np.complex64)
+    for k0 in range(0, K, k_tile):
+        H_tile = H_T[k0:k0 + k_tile]
+        if H_tile.dtype == np.uint16:  # dequantize only the current tile
+            H_tile = from_bfloat16(H_tile).view(np.complex64)
+        # einsum multiplies and reduces over the partitions in one pass, no (K, P) temporary
+        acc[k0:k0 + k_tile] = np.einsum('kp,kp->k', FDL_T[k0:k0 + k_tile, idx], H_tile)
+    return acc
+
+
+if njit is not None:
+    def load_tile(H_T, k0, k1):
+        '''rows k0:k1 of the filter as interleaved re/im float32 (implemented for numba below)'''
+
+    @overload(load_tile)
+    def ol_load_tile(H_T, k0, k1):
+        if H_T.dtype == types.uint16:  # bfloat16 re/im pairs
+            return lambda H_T, k0, k1: (H_T[k0:k1].astype(np.uint32) << np.uint32(16)).view(np.float32)
+        return lambda H_T, k0, k1: H_T.view(np.float32)[k0:k1]
+
+    @njit(fastmath=True, cache=True)
+    def mac_rows(F, Hf, a, idx, k0, k1, P):
+        '''accumulates bins k0:k1 into a, F/Hf/a are interleaved re/im float32 and Hf holds rows k0:k1'''
+        # the complex product is spelled out as real multiply-adds with separate re/im accumulators
+        # (fastmath lets LLVM contract them into FMAs)
+        for k in range(k0, k1):
+            re = np.float32(0)
+            im = np.float32(0)
+            for p in range(P):  # H row k is read in order, FDL row k is gathered through the ring index
+                j = idx[p]
+                re += F[k, 2 * j] * Hf[k - k0, 2 * p] - F[k, 2 * j + 1] * Hf[k - k0, 2 * p + 1]
+                im += F[k, 2 * j] * Hf[k - k0, 2 * p + 1] + F[k, 2 * j + 1] * Hf[k - k0, 2 * p]
+            a[2 * k] = re
+            a[2 * k + 1] = im
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def upols_mac_jit(FDL_T, H_T, idx):
+        '''compiled upols_mac for any (K, P), cached on disk'''
+        K = FDL_T.shape[0]
+        P = idx.shape[0]
+        k_tile = max(1, TILE_BYTES // (2 * P * 8))
+        acc = np.empty(K, dtype=np.complex64)
+        F = FDL_T.view(np.float32)
+        a = acc.view(np.float32)
+        for t in prange((K + k_tile - 1) // k_tile):  # tiles of frequency bins run in parallel
+            k0 = t * k_tile
+            k1 = min(K, k0 + k_tile)
+            mac_rows(F, load_tile(H_T, k0, k1), a, idx, k0, k1, P)
+        return acc
+
+    compiled_macs = {}  # specialized kernels, keyed on (K, P, bf16)
+
+    def compile_upols_mac(K, P, bf16=False):
+        '''
+        upols_mac compiled for K frequency bins and P partitions only (loop bounds and tiling are compile-time
+        constants), bf16 tells whether H_T is quantized. Closures can't be cached on disk, so this takes a
+        second or two per new shape; it is compiled without being run, so it is safe to call from a thread.
+        '''
+        k_tile = max(1, TILE_BYTES // (2 * P * 8))
+        n_tiles = (K + k_tile - 1) // k_tile
+
+        @njit(parallel=True, fastmath=True)
+        def upols_mac_KP(FDL_T, H_T, idx):
+            acc = np.empty(K, dtype=np.complex64)
+            F = FDL_T.view(np.float32)
+            a = acc.view(np.float32)
+            for t in prange(n_tiles):  # tiles of frequency bins run in parallel
+                k0 = t * k_tile
+                k1 = min(K, k0 + k_tile)
+                mac_rows(F, load_tile(H_T, k0, k1), a, idx, k0, k1, P)
+            return acc
+
+        H_T = np.zeros((1, 2), dtype=np.uint16) if bf16 else np.zeros((1, 1), dtype=np.complex64)
+        upols_mac_KP.compile((typeof(np.zeros((1, 1), dtype=np.complex64)), typeof(H_T),
+                              typeof(np.zeros((1,), dtype=int))))
+        compiled_macs[K, P, bf16] = upols_mac_KP
+        return upols_mac_KP
 
 
 class FIRfilter():
-    def __init__(self, method="overlap-save", B=512, h=None, partition=None, normalize=True):
+    def __init__(self, method="overlap-save", B=512, h=None, partition=None, normalize=True, quantize_ir=False):
         '''
         Performs real-time convolution via FIR filters.
 
@@ -44,7 +159,8 @@ class FIRfilter():
         method : str, optional
             The FIR method to use, available ones are 'overlap-save', 'overlap-add',
             'OLS' (same as overlap-save), 'OLA' (same as overlap-add),
-            'UPOLS' (uniformly partitioned overlap-save). The default is "overlap-save".
+            'UPOLS' (uniformly partitioned overlap-save), 'UPOLS-GPU' (UPOLS on the GPU, requires cupy).
+            The default is "overlap-save".
         B : int, optional
             Block size/buffer size, define the size of the audio chunk being procesed
             at a time unit. The default is 512.
@@ -57,6 +173,10 @@ class FIRfilter():
         normalize : bool, optional
             Indicate if output should be normalized or not. If True the frame output is going to
             be normalized to be below 1. The default is True.
+        quantize_ir : bool, optional
+            Store the partitioned filter as bfloat16, halving the memory read per block for long impulse
+            responses, at the cost of filter precision (8 bit mantissa). Only supported by the 'UPOLS'
+            method (not 'UPOLS-GPU', 'OLA' or 'OLS'). The default is False.
 
         Returns
         -------
@@ -67,36 +187,52 @@ class FIRfilter():
         self.method = method.lower()
         self.B = B                # block size (audio input len, which will also be the output size)
         self.NFFT = None          # fft/ifft size
+        self.fft_plans = {}       # cached fft/ifft pairs, keyed on (input shape, NFFT)
         self.flagIRchanged = True  # check if the IR changed or it's still the same
-        self.stored_h = h        # save IR for comparison next frame (optional input)
-        if h is not None:
-            self.Nh = max(h.shape)
-            self.generate_ref()
-        self.left_overs = np.zeros((self.B,))  # remaining samples from last ifft (OLA)
+        self.stored_h = None     # IR, set through set_ir (optional input)
+        self.left_overs = np.zeros((self.B,), dtype=np.float32)  # remaining samples from last ifft (OLA)
         self.partition = partition  # partition size (UPOLS)
         self.normalize = normalize
+        self.quantize_ir = quantize_ir  # bfloat16 filter (UPOLS)
+        self.mac_lock = Lock()    # guards swapping in the specialized UPOLS kernel (see swap_in_kernel)
 
-        validMethods = ['overlap-save', 'overlap-add', 'ols', 'ola', 'upols']
+        validMethods = ['overlap-save', 'overlap-add', 'ols', 'ola', 'upols', 'upols-gpu']
         error_msg = f'Unknown FIRfilter method: "{self.method}", \n Supported methods are: {validMethods}'
         assert self.method in validMethods, error_msg
+        assert self.method != 'upols-gpu' or cp is not None, 'The "upols-gpu" method requires cupy'
+        assert not quantize_ir or self.method == 'upols', 'quantize_ir is only supported by the "upols" method'
+        # resolve the method once instead of comparing strings on every block
+        self.process_method = {'overlap-save': self.OLS, 'ols': self.OLS,
+                               'overlap-add': self.OLA, 'ola': self.OLA,
+                               'upols': self.UPOLS, 'upols-gpu': self.UPOLS_GPU}[self.method]
 
-        if ('upols' in self.method) and (partition is None) and (h is not None):
-            self.partition, self.NFFT = self.optimize_UPOLS_parameters(self.Nh, self.B)
-            print(f'partition size: {self.partition} \n nfft: {self.NFFT}')
+        if h is not None:
+            self.set_ir(h)
 
-    def pad_the_end(self, x, new_length):
-        if x.shape[0] < new_length:
-            output = np.zeros((new_length,))
-            output[:x.shape[0]] = x
-        else:
-            output = x
-        return output
+    def pad_the_end(self, x, new_length, dtype=np.float32):
+        return np.pad(x.astype(dtype, copy=False), (0, max(new_length - x.shape[0], 0)))
 
-    def pad_beginning(self, x, padding):
-        new_length = max(x.shape) + padding
-        output = np.zeros((new_length,))
-        output[-x.shape[0]:] = x
-        return output
+    def pad_beginning(self, x, padding, dtype=np.float32):
+        return np.pad(x.astype(dtype, copy=False), (padding, 0))
+
+    def set_ir(self, h):
+        '''
+        Replace the impulse response. For UPOLS the filter is partitioned and its FFTs planned right away; a
+        generic compiled kernel (cached on disk by numba) is used until the one specialized for the new number
+        of bins and partitions has been compiled in the background. For OLA/OLS its spectrum is computed on
+        the next processed block.
+        Call this after modifying the current IR array in place, process() only checks for a new array.
+        '''
+        if max(h.shape) != getattr(self, 'Nh', None) and 'upols' not in self.method:
+            self.NFFT = None  # new IR length, the OLA/OLS FFT size and buffers are rebuilt on the next block
+        self.stored_h = h
+        self.Nh = max(h.shape)
+        self.flagIRchanged = True
+        self.generate_ref()
+        if self.method == 'upols':
+            self.load_UPOLS(h)
+        elif self.method == 'upols-gpu':
+            self.load_UPOLS_GPU(h)
 
     def generate_ref(self):
         '''
@@ -110,11 +246,13 @@ class FIRfilter():
         else:
             self.N_ch = 1
 
-    def normalize_output(self, data):
-        return data / self.ref
+    def UPOLS_nfft(self, L, B):
+        '''FFT size used by UPOLS for partition size L and block size B'''
+        d_max = B - math.gcd(L, B)
+        return scipy.fft.next_fast_len(B + L + d_max, real=True)  # avoid slow FFT sizes
 
     def optimize_UPOLS_parameters(self, N, B):
-        '''brute-force the optimal parameters for UPOLS
+        '''brute-force the optimal partition size for UPOLS (the FFT size follows from it, see UPOLS_nfft)
             N: IR length
             B: buffer size
         '''
@@ -122,31 +260,71 @@ class FIRfilter():
             # theoretical time estimates for each operation, pag. 211
             return 1 / B * (1.68 * K * np.log2(K) + 3.49 * K * np.log2(K) + 6 * ((K + 1) / 2) + ((N / L) - 1) * 8 * ((K + 1) / 2))
 
-        c_opt = Inf
-        rang = np.array([2**k for k in range(0, int(np.log2(N)))]).astype('int')
+        c_opt = math.inf
+        rang = [2**k for k in range(0, int(math.log2(N)))]
         for L in rang:
-            d_max = B - np.gcd(L, B)
-            K_min = int(B + L + d_max - 1)
-            K_max = int(2**np.ceil(np.log2(K_min)))
-            k_sort = np.sort([K_min, K_max])
-            if k_sort[0] == k_sort[1]:
-                k_sort[1] = k_sort[1] + 1
-
-            K_range = np.arange(k_sort[0], k_sort[1] + 1)
-            for K in K_range:
-                c = cost(B, N, L, K)
-                if c < c_opt:
-                    c_opt = c
-                    L_opt = L
-                    K_opt = K
-        return L_opt, K_opt
+            c = cost(B, N, L, self.UPOLS_nfft(L, B))  # costed at the FFT size UPOLS will actually use
+            if c < c_opt:
+                c_opt = c
+                L_opt = L
+        return L_opt
+
+    def fft_plan(self, shape):
+        '''
+        Real forward/inverse transform pair along axis 0 for inputs of a given shape (zero-padded to NFFT).
+        Spectra only hold the NFFT//2+1 non-negative frequency bins.
+        Plans are built once per (shape, NFFT) and reused on every block: pyFFTW (FFTW_MEASURE) if
+        installed, otherwise scipy.fft (pocketfft, multithreaded).
+        '''
+        key = (shape, self.NFFT)
+        if key not in self.fft_plans:
+            if pyfftw is not None:
+                fwd = pyfftw.builders.rfft(pyfftw.empty_aligned(shape, dtype='float32'), n=self.NFFT, axis=0,
+                                           threads=1, planner_effort='FFTW_MEASURE')
+                inv_plan = pyfftw.builders.irfft(pyfftw.empty_aligned((self.NFFT // 2 + 1,) + shape[1:], dtype='complex64'),
+                                                 n=self.NFFT, axis=0, threads=1, planner_effort='FFTW_MEASURE')
+
+                def inv(X):
+                    return inv_plan(X).copy()  # plan output buffer is reused on the next call
+            else:
+                fwd = partial(scipy.fft.rfft, n=self.NFFT, axis=0, workers=-1)
+                inv = partial(scipy.fft.irfft, n=self.NFFT, axis=0, workers=-1)
+            self.fft_plans[key] = (fwd, inv)
+        return self.fft_plans[key]
+
+    def init_input_buffer(self):
+        '''
+        Input buffer for the sliding window of OLS/UPOLS. It holds several blocks beyond NFFT so that
+        new blocks are written at an advancing position instead of shifting the whole window every frame.
+        '''
+        n_blocks = -(-self.NFFT // self.B)  # ceil
+        self.input_buffer = np.zeros(shape=(self.NFFT - self.B + n_blocks * self.B,), dtype=np.float32)
+        self.write_pos = self.NFFT - self.B  # where the next block goes, the window ends right after it
+
+    def slide_input(self, x):
+        '''
+        Appends block x to the input buffer and returns the latest NFFT samples (a view, no copy).
+        The window is only moved back to the start of the buffer when its end is reached.
+        '''
+        if self.write_pos == self.input_buffer.shape[0]:
+            keep = self.NFFT - self.B
+            self.input_buffer[:keep] = self.input_buffer[self.write_pos - keep:self.write_pos]
+            self.write_pos = keep
+        self.input_buffer[self.write_pos:self.write_pos + self.B] = x
+        self.write_pos += self.B
+        return self.input_buffer[self.write_pos - self.NFFT:self.write_pos]
 
     def fft_conv(self, x):
-        X = fft(x, self.NFFT, axis=0)
+        fft, ifft = self.fft_plan(x.shape)
+        X = fft(x.astype(np.float32, copy=False))
         if self.flagIRchanged:  # store the IR fft
-            self.H = fft(self.stored_h, self.NFFT, axis=0)
+            H = scipy.fft.rfft(self.stored_h.astype(np.float32, copy=False), self.NFFT, axis=0)
+            self.H = np.ascontiguousarray(H, dtype=np.complex64)
+            if self.normalize:  # output normalization folded into the filter
+                self.H *= np.float32(1 / self.ref)
+            self.spec_scratch = np.empty_like(self.H)  # product spectrum, reused every block
             self.flagIRchanged = False
-        return ifft(X * self.H, axis=0).real
+        return ifft(np.multiply(X, self.H, out=self.spec_scratch))
 
     # Main ---------------------------------------------------------------------------------------------
     def OLA(self, x, h):
@@ -154,96 +332,165 @@ class FIRfilter():
         Overlap-add convolution
         '''
         if self.NFFT is None:
-            self.NFFT = self.B + max(h.shape) - 1
-            self.left_overs = np.squeeze(np.zeros((self.NFFT, self.N_ch)))
+            self.NFFT = scipy.fft.next_fast_len(self.B + max(h.shape) - 1, real=True)  # avoid slow FFT sizes
             self.len_y_left = self.NFFT - self.B
-
-        # Fast convolution
-        y = self.fft_conv(x)
-
-        # Overlap-Add the partial convolution result
-        out = y[:self.B, ...] + self.left_overs[:self.B, ...]
-
-        self.left_overs = np.roll(self.left_overs, -self.B, axis=0)  # flush the buffer
-        self.left_overs[-self.B:, ...] = 0
-        self.left_overs[:self.len_y_left, ...] = self.left_overs[:self.len_y_left, ...] + y[self.B:, ...]
-        if self.normalize:
-            return self.normalize_output(out)
-        else:
-            return out
+            self.left_overs = np.zeros((self.len_y_left,) + h.shape[1:], dtype=np.float32)
+            self.ola_input = np.zeros((self.NFFT,) + np.shape(x)[1:], dtype=np.float32)  # zero-padded input block
+
+        # Fast convolution, the block is written in place, the zero tail is never touched
+        n = x.shape[0]  # a short (last) block is zero-padded up to B
+        self.ola_input[:n] = x
+        self.ola_input[n:self.B] = 0
+        y = self.fft_conv(self.ola_input)
+
+        # Overlap-Add the partial convolution result (y is a fresh array, add in place)
+        out = y[:self.B, ...]
+        n_out = min(self.B, self.len_y_left)
+        out[:n_out, ...] += self.left_overs[:n_out, ...]
+
+        # flush the buffer: move the still pending samples to the front, in place, then add the new tail
+        n_left = max(self.len_y_left - self.B, 0)
+        self.left_overs[:n_left, ...] = self.left_overs[self.B:, ...]
+        self.left_overs[n_left:, ...] = 0
+        self.left_overs += y[self.B:, ...]
+        return out
 
     def OLS(self, x, h):
         '''
         Overlap-save convolution
         '''
         if self.NFFT is None:
-            self.NFFT = self.B + max(h.shape) - 1
-            # Input buffer
-            self.OLS_input_buffer = np.zeros(shape=(self.NFFT,))
+            self.NFFT = scipy.fft.next_fast_len(self.B + max(h.shape) - 1, real=True)  # avoid slow FFT sizes
+            self.init_input_buffer()
 
-        # Sliding window of the input
-        self.OLS_input_buffer = np.roll(self.OLS_input_buffer, shift=-self.B)  # previous contents are shifted B samples to the left
-        self.OLS_input_buffer[-self.B:] = x  # next length-B input block is stored rightmost
+        # Sliding window of the input, the next length-B input block is stored rightmost
+        window = self.slide_input(x)
 
         # Fast convolution
-        out = self.fft_conv(self.OLS_input_buffer)
+        out = self.fft_conv(window)
 
-        if self.normalize:
-            return self.normalize_output(out[-self.B:])
-        else:
-            return out[-self.B:]
+        return out[-self.B:]
+
+    def init_UPOLS(self, h):
+        '''
+        Partition the impulse response h into the UPOLS filter H_T (shared by UPOLS and UPOLS_GPU).
+        The input buffer and the FDL are only reset when the FFT size or the number of partitions change,
+        so swapping the IR for one of the same length keeps the running stream. Returns True on a reset.
+        '''
+        Nh = max(h.shape)
+        optimize = self.partition is None
+        if optimize:
+            print('Running UPOLS parameter optimization, to avoid this optimization prcedure, simply declare a "partition" value at the class initialization')
+            self.partition = self.optimize_UPOLS_parameters(Nh, self.B)
+        L_partit = self.partition
+        NFFT = self.UPOLS_nfft(L_partit, self.B)
+        if optimize:
+            print(f'partition size: {self.partition} \n nfft: {NFFT}')
+        P = -(-Nh // L_partit)  # number of partitions done
+
+        reset = (NFFT, P) != (self.NFFT, getattr(self, 'P', None))
+        if reset:
+            self.NFFT, self.P = NFFT, P
+            self.init_input_buffer()
+        nm = np.zeros((P,), dtype=int)  # tells us which FDL positions should be used
+        h_mat = np.zeros((P, NFFT), dtype=np.float32)  # zero-padded sub filters (time domain)
+
+        # (1) split original filter into P length-L sub filters
+        for m, ii in enumerate(range(0, Nh, L_partit)):
+            h_partit = h[ii:ii + L_partit]
+
+            # (2) incorporate "remainder delays"
+            dm = (m * L_partit) % self.B
+            h_mat[m, dm:dm + h_partit.shape[0]] = h_partit
+            nm[m] = (m * L_partit) // self.B  # FDL active slots
+        # partitioned filters (freq domain), all partitions in a single transform
+        # both are stored bin-major, (K, P), so that the sum over partitions reads contiguous memory
+        self.H_T = np.ascontiguousarray(scipy.fft.rfft(h_mat, axis=1, workers=-1).T)
+        if self.normalize:  # output normalization folded into the filter
+            self.H_T *= np.float32(1 / self.ref)
+        if reset:
+            self.nm = nm
+            self.FDL_T = np.zeros((NFFT // 2 + 1, max(nm) + 1), dtype=np.complex64)  # delay line
+            self.fdl_head = 0  # FDL is a ring buffer, the newest spectrum is at fdl_head
+        return reset
+
+    def load_UPOLS(self, h):
+        '''
+        Set up UPOLS for the impulse response h, called from set_ir so the kernel compilation stays out of
+        the audio callback
+        '''
+        self.init_UPOLS(h)
+        if self.quantize_ir:  # interleaved re/im bfloat16, shape (K, 2P)
+            self.H_T = to_bfloat16(self.H_T.view(np.float32))
+        self.fft_plan((self.NFFT,))  # plan the block transforms now as well
+        with self.mac_lock:
+            self.mac_key = (self.NFFT // 2 + 1, self.P, self.quantize_ir)
+            if njit is None:
+                self.mac = upols_mac
+            elif self.mac_key in compiled_macs:
+                self.mac = compiled_macs[self.mac_key]
+            else:  # generic kernel (cached on disk) until the one specialized for this (K, P) is compiled
+                self.mac = upols_mac_jit
+                self.mac(self.FDL_T[:1], self.H_T[:1], np.zeros((1,), dtype=int))  # load/compile it here
+                Thread(target=self.swap_in_kernel, args=(self.mac_key,), daemon=True).start()
+        self.flagIRchanged = False
+
+    def swap_in_kernel(self, key):
+        '''
+        Compiles the MAC kernel specialized for key = (K, P, bf16) and, unless the IR has changed shape in the
+        meantime, replaces the generic one with it
+        '''
+        kernel = compile_upols_mac(*key)
+        with self.mac_lock:
+            if self.mac_key == key:
+                self.mac = kernel
 
     def UPOLS(self, x, h):
         '''(generalized) Uniformly Partitioned Overlap-Save
             - generalized means that you can pick the partition size
         '''
-        if self.flagIRchanged:  # only run on on initial call
-            Nh = max(h.shape)
-            if self.partition is None:
-                print('Running UPOLS parameter optimization, this may take a few minutes to run deppending on the length of the impulse respose, to avoid this optimization prcedure, simply declare a "partition" value at the class initialization')
-                self.partition, self.NFFT = self.optimize_UPOLS_parameters(Nh, self.B)
-                L_partit = self.partition
-            else:
-                L_partit = self.partition
-                dmax = self.B - np.gcd(L_partit, self.B)
-                self.NFFT = self.B + L_partit + dmax
-
-            self.P = int(np.ceil(Nh / L_partit))  # number of partitions done
-            self.input_buffer = np.zeros(shape=(self.NFFT,))  # Initialize input buffer
-            # Initialize filter and FDL
-            self.nm = np.zeros((self.P,))  # tells us which FDL positions should be used
-            self.H = np.zeros((self.P, self.NFFT), dtype='complex_')  # partitioned filters (freq domain)
-
-            # (1) split original filter into P length-L sub filters
-            for m, ii in enumerate(range(0, Nh, L_partit)):
-                try:
-                    h_partit = h[ii:ii + L_partit]
-                except Exception:
-                    h_partit = self.pad_the_end(h[ii:], L_partit)
-
-                # (2) incorporate "remainder delays"
-                dm = np.mod(m * L_partit, self.B)
-                h_pad = self.pad_beginning(h_partit, dm)
-                self.H[m, :] = fft(h_pad, n=self.NFFT)
-                self.nm[m] = np.floor(m * L_partit / self.B)  # FDL active slots
-            self.nm = self.nm.astype(int)
-            self.FDL = np.zeros((max(self.nm) + 1, self.NFFT), dtype='complex_')  # delay line
-            self.flagIRchanged = False
+        fft, ifft = self.fft_plan((self.NFFT,))
 
-        # (3) Sliding window of the input
-        self.input_buffer = np.roll(self.input_buffer, shift=-self.B)  # previous contents are shifted B samples to the left
-        self.input_buffer[-self.B:] = x  # next length-B input block is stored rightmost
+        # (3) Sliding window of the input, the next length-B input block is stored rightmost
+        window = self.slide_input(x)
         # (4) Stream
-        self.FDL = np.roll(self.FDL, shift=1, axis=0)  # shift the FDL to create space for current input
-        self.FDL[0, :] = fft(self.input_buffer)  # add current buffer to the first FDL slot
+        P_fdl = self.FDL_T.shape[1]
+        self.fdl_head = (self.fdl_head - 1) % P_fdl  # move the head back instead of shifting the FDL
+        self.FDL_T[:, self.fdl_head] = fft(window)  # add current buffer to the first FDL slot
         # convo
         # note: the sum is done in the frequency domain (yep!)
-        out = ifft(np.sum(self.FDL[self.nm, :] * self.H, axis=0)).real
+        out = ifft(self.mac(self.FDL_T, self.H_T, (self.fdl_head + self.nm) % P_fdl))
 
-        if self.normalize:
-            return self.normalize_output(out[-self.B:])
-        else:
-            return out[-self.B:]
+        return out[-self.B:]
+
+    def load_UPOLS_GPU(self, h):
+        '''
+        Set up GPU UPOLS for the impulse response h (called from set_ir)
+        '''
+        if self.init_UPOLS(h):  # new buffers, move delay line and input buffer to the device
+            self.FDL_T = cp.asarray(self.FDL_T)
+            self.nm = cp.asarray(self.nm)
+            self.input_buffer = cp.asarray(self.input_buffer)
+            self.stream = cp.cuda.Stream(non_blocking=True)
+        self.H_T = cp.asarray(self.H_T)
+        self.flagIRchanged = False
+
+    def UPOLS_GPU(self, x, h):
+        '''
+        Uniformly Partitioned Overlap-Save running on the GPU (CuPy/cuFFT), worth it for long IRs
+        '''
+        with self.stream:
+            # (3) Sliding window of the input
+            window = self.slide_input(cp.asarray(x, dtype=cp.float32))
+            # (4) Stream
+            P_fdl = self.FDL_T.shape[1]
+            self.fdl_head = (self.fdl_head - 1) % P_fdl
+            self.FDL_T[:, self.fdl_head] = cp.fft.rfft(window, n=self.NFFT)
+            acc = cp.einsum('kp,kp->k', self.FDL_T[:, (self.fdl_head + self.nm) % P_fdl], self.H_T)
+            out = cp.asnumpy(cp.fft.irfft(acc, n=self.NFFT)[-self.B:], stream=self.stream)
+        self.stream.synchronize()
+
+        return out
 
     # def NUPOLS(self,x,h):
     #     '''Non Uniformly Partitioned Overlap-Save
@@ -293,18 +540,15 @@ class FIRfilter():
 
 # %% Main ###############################################################################
     def process(self, x, h=None):
-        if h is not None and np.any(h != self.stored_h):   # check if the impulse response h has changed
-            self.flagIRchanged = True
-            self.stored_h = h
-            self.generate_ref()
-            print(self.flagIRchanged)
-        else:
-            h = self.stored_h
+        '''
+        Convolves block x with the impulse response. h is only treated as a new IR when it is a different
+        array object than the stored one (identity, not value, comparison): passing the same array again is
+        free, any other array (even an equal one or a new view) reloads the IR. To apply in-place changes to
+        the stored IR, call set_ir(). A new IR is loaded inside this call (for UPOLS: partitioning the filter
+        and planning its FFTs), so to keep that work out of the audio callback call set_ir() beforehand.
+        '''
+        if h is not None and h is not self.stored_h:   # check if a new impulse response h was passed
+            self.set_ir(h)
 
         # convolve
-        if self.method == 'overlap-save' or self.method == 'ols':
-            return self.OLS(x, h)
-        elif self.method == 'overlap-add' or self.method == 'ola':
-            return self.OLA(x, h)
-        elif self.method == 'upols':
-            return self.UPOLS(x, h)
+        return self.process_method(x, self.stored_h)